@@ -1,14 +1,22 @@
+import functools
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from io import BytesIO, StringIO
-
-import pandas as pd
+from io import BytesIO
+from typing import TYPE_CHECKING
 
 from airflow.sdk import dag, task
-from airflow.providers.postgres.hooks.postgres import PostgresHook
-from airflow.providers.amazon.aws.hooks.s3 import S3Hook
 from airflow.models import Variable
 
+# Le fichier est re-parsé en continu par le dag-processor : pandas, polars, pyarrow, pgpq et
+# les providers ne sont importés que dans les fonctions exécutées par les tasks
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+    from airflow.providers.postgres.hooks.postgres import PostgresHook
+    from airflow.providers.amazon.aws.hooks.s3 import S3Hook
+
 logger = logging.getLogger(__name__)
 
 
@@ -17,17 +25,180 @@ class DataInjectionError(Exception):
     pass
 
 
+# Tables cibles : colonnes et clé de conflit
+TABLES = {
+    'client': (
+        ['customer_id', 'first_name', 'last_name', 'email', 'country', 'signup_date', 'gender', 'age_range'],
+        'customer_id'
+    ),
+    'product': (
+        ['product_id', 'product_name', 'brand', 'category', 'cost_price', 'color', 'size', 'catalog_price'],
+        'product_id'
+    ),
+    'sale': (
+        ['sale_id', 'sale_date', 'channel', 'channel_campaigns', 'customer_id'],
+        'sale_id'
+    ),
+    'sale_product': (
+        ['item_id', 'sale_id', 'product_id', 'quantity', 'discount_applied'],
+        'item_id'
+    ),
+}
+
+# Conditions ajoutées à l'INSERT ... SELECT depuis la table temporaire : une date
+# déjà présente dans sale n'est pas rechargée, et les lignes de sale_product dont la
+# vente a été écartée sont ignorées au lieu de violer la clé étrangère
+INSERT_GUARDS = {
+    'sale': "WHERE NOT EXISTS (SELECT 1 FROM sale s WHERE s.sale_date = stg_sale.sale_date)",
+    'sale_product': "WHERE EXISTS (SELECT 1 FROM sale s WHERE s.sale_id = stg_sale_product.sale_id)",
+}
+
+# Lecture des objets MinIO par plages d'octets concurrentes
+RANGE_WORKERS = 16
+RANGE_MIN_SIZE = 256 * 1024
+
+# Types (polars) imposés au parseur CSV pour chaque colonne chargée : polars n'infère les
+# types que sur les 100 premières lignes (une taille "35" ferait typer size en entier).
+# sale_date est lu en texte pour le filtrage, identifiants et quantités en int32 comme les
+# colonnes INTEGER cibles
+CSV_COLUMN_TYPES = {
+    'sale_date': 'String',
+    'sale_id': 'Int32',
+    'item_id': 'Int32',
+    'customer_id': 'Int32',
+    'product_id': 'Int32',
+    'quantity': 'Int32',
+    'discount_applied': 'Float64',
+    'channel': 'String',
+    'channel_campaigns': 'String',
+    'product_name': 'String',
+    'brand': 'String',
+    'category': 'String',
+    'cost_price': 'Float64',
+    'color': 'String',
+    'size': 'String',
+    'catalog_price': 'Float64',
+    'first_name': 'String',
+    'last_name': 'String',
+    'email': 'String',
+    'country': 'String',
+    'signup_date': 'Date',
+    'gender': 'String',
+    'age_range': 'String',
+}
+
+DATE_RE = re.compile(r"[0-9]{8}")
+
+
 def validate_date(date: str) -> bool:
     """Valide le format de date YYYYMMDD"""
-    if len(date) != 8 or not date.isdigit():
+    if not DATE_RE.fullmatch(date):
         return False
     try:
-        datetime.strptime(date, "%Y%m%d")
+        datetime(int(date[:4]), int(date[4:6]), int(date[6:]))
         return True
     except ValueError:
         return False
 
 
+def copy_table(cur, df: "pd.DataFrame", table: str) -> int:
+    """Charge df dans table via COPY binaire puis INSERT ... ON CONFLICT, retourne le nombre de lignes insérées"""
+    import pyarrow as pa
+    from pgpq import ArrowToPostgresBinaryEncoder
+    
+    columns, key = TABLES[table]
+    cols = ", ".join(columns)
+    
+    # Une ligne par clé : un client ou un produit revient sur plusieurs lignes de vente
+    data = pa.Table.from_pandas(df[columns].drop_duplicates(key), preserve_index=False)
+    
+    # pgpq encode les colonnes Arrow au format COPY binaire : ni texte côté client, ni parsing côté serveur.
+    # La table temporaire prend les types Postgres correspondant aux types Arrow,
+    # l'INSERT ... SELECT fait la conversion vers les types de la table cible.
+    encoder = ArrowToPostgresBinaryEncoder(data.schema)
+    stg_cols = ", ".join(f"{column.name} {column.data_type.ddl()}" for column in encoder.schema().columns)
+    
+    buf = BytesIO()
+    buf.write(encoder.write_header())
+    for batch in data.to_batches():
+        buf.write(encoder.write_batch(batch))
+    buf.write(encoder.finish())
+    buf.seek(0)
+    
+    cur.execute(f"CREATE TEMP TABLE stg_{table} ({stg_cols}) ON COMMIT DROP")
+    cur.copy_expert(f"COPY stg_{table} ({cols}) FROM STDIN WITH (FORMAT BINARY)", buf)
+    cur.execute(f"""
+        INSERT INTO {table} ({cols})
+        SELECT {cols} FROM stg_{table}
+        {INSERT_GUARDS.get(table, '')}
+        ON CONFLICT ({key}) DO NOTHING
+    """)
+    return cur.rowcount
+
+
+@functools.lru_cache(maxsize=32)
+def format_date(date: str) -> str:
+    """Convertit YYYYMMDD en YYYY-MM-DD"""
+    return datetime.strptime(date, "%Y%m%d").strftime("%Y-%m-%d")
+
+
+@functools.lru_cache(maxsize=None)
+def get_pg_hook() -> "PostgresHook":
+    """PostgresHook construit une seule fois par processus (chaque task tourne dans le sien)"""
+    from airflow.providers.postgres.hooks.postgres import PostgresHook
+    
+    return PostgresHook(postgres_conn_id='postgres_external')
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_hook() -> "S3Hook":
+    """S3Hook (MinIO) construit une seule fois par processus (chaque task tourne dans le sien)"""
+    from airflow.providers.amazon.aws.hooks.s3 import S3Hook
+    
+    return S3Hook(aws_conn_id='minio_s3')
+
+
+def read_object(s3_hook, bucket_name: str, key: str, head: dict) -> bytes:
+    """Télécharge un objet (décrit par son HEAD) en GET Range parallèles plutôt qu'en un seul GET bloquant"""
+    size, etag = head['ContentLength'], head['ETag']
+    if size == 0:
+        return b""
+    
+    parts = max(1, min(RANGE_WORKERS, size // RANGE_MIN_SIZE))
+    step = -(-size // parts)
+    ranges = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+    
+    client = s3_hook.get_conn()
+    
+    def fetch(byte_range):
+        start, end = byte_range
+        # IfMatch : si l'objet est remplacé entre deux plages, la requête échoue (412)
+        # au lieu de recoller des morceaux de deux versions différentes
+        return client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)['Body'].read()
+    
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        return b"".join(executor.map(fetch, ranges))
+
+
+def read_sales_csv(csv_content: bytes, sale_date: str) -> "pa.Table":
+    """Parse le CSV sur tous les cœurs en ne gardant que les lignes de sale_date"""
+    import polars as pl
+    
+    schema_overrides = {name: getattr(pl, dtype) for name, dtype in CSV_COLUMN_TYPES.items()}
+    
+    # Le filtre est poussé dans le scan : les autres dates ne sont jamais matérialisées
+    return (
+        pl.scan_csv(csv_content, schema_overrides=schema_overrides)
+        # Seules les colonnes chargées sont parsées, les autres ne dépendent pas de l'inférence
+        .select(list(schema_overrides))
+        .filter(pl.col('sale_date') == sale_date)
+        # sale_date n'est lu en texte que pour le filtrage
+        .with_columns(pl.col('sale_date').str.to_date('%Y-%m-%d'))
+        .collect()
+        .to_arrow()
+    )
+
+
 @dag(
     dag_id='fashion_store_data_injection',
     description='Injection des données de vente depuis MinIO vers PostgreSQL',
@@ -57,54 +228,34 @@ def fashion_store_etl():
     
     
     @task
-    def check_date_exists(date: str) -> bool:
-        formatted_date = datetime.strptime(date, "%Y%m%d").strftime("%Y-%m-%d")
-        
-        pg_hook = PostgresHook(postgres_conn_id='postgres_external')
-        
-        try:
-            result = pg_hook.get_first(
-                sql="SELECT EXISTS(SELECT 1 FROM sale WHERE sale_date = %s)",
-                parameters=(formatted_date,)
-            )
-            
-            exists = result[0]
-            
-            if exists:
-                logger.warning(f"Les données pour {formatted_date} existent déjà en base")
-            else:
-                logger.info(f"Aucune donnée existante pour {formatted_date}")
-            
-            return exists
-            
-        except Exception as e:
-            logger.error(f"Erreur lors de la vérification de la date: {e}")
-            raise DataInjectionError("Impossible de vérifier la date en base") from e
-    
-    
-    @task
-    def extract_data_from_minio(date: str, date_exists: bool) -> str:
+    def extract_data_from_minio(date: str, **context) -> str:
+      import pandas as pd
       
-      if date_exists:
-          logger.info("Données déjà présentes, extraction ignorée")
-          return None
-      
-      formatted_date = datetime.strptime(date, "%Y%m%d").strftime("%Y-%m-%d")
+      formatted_date = format_date(date)
       bucket_name = Variable.get("minio_bucket_name")
       file_name = Variable.get("file_name")
       
-      # Utiliser S3Hook pour MinIO
-      s3_hook = S3Hook(aws_conn_id='minio_s3')
+      s3_hook = get_s3_hook()
       
       try:
-          logger.info(f"Récupération des données depuis MinIO: {bucket_name}/{file_name}")
+          # L'ETag de la source fait partie de la clé : un CSV corrigé donne une nouvelle clé
+          # au lieu de retomber sur le Parquet extrait d'une version précédente
+          head = s3_hook.head_object(key=file_name, bucket_name=bucket_name)
+          etag = head['ETag'].strip('"')
+          staging_key = f"staging/{context['ti'].dag_id}/{date}/{etag}.parquet"
           
-          obj = s3_hook.get_key(key=file_name, bucket_name=bucket_name)
-          csv_content = obj.get()['Body'].read()
+          # Un retry sur la même version de la source réutilise le Parquet déjà déposé
+          if s3_hook.check_for_key(key=staging_key, bucket_name=bucket_name):
+              logger.info(f"Données déjà extraites: {bucket_name}/{staging_key}")
+              return staging_key
           
-          df = pd.read_csv(BytesIO(csv_content))
+          logger.info(f"Récupération des données depuis MinIO: {bucket_name}/{file_name}")
           
-          df_filtered = df[df["sale_date"] == formatted_date].drop_duplicates()
+          csv_content = read_object(s3_hook, bucket_name, file_name, head)
+          
+          # Parsing et filtrage multi-cœurs par polars : seules les lignes du jour passent en pandas
+          # Colonnes adossées à Arrow : les valeurs manquantes restent des NULL (bitmap), pas des NaN/objets
+          df_filtered = read_sales_csv(csv_content, formatted_date).to_pandas(types_mapper=pd.ArrowDtype).drop_duplicates()
           
           if df_filtered.empty:
               logger.warning(f"Aucune donnée trouvée pour la date {formatted_date}")
@@ -112,98 +263,55 @@ def fashion_store_etl():
           
           logger.info(f"{len(df_filtered)} lignes extraites pour {formatted_date}")
           
-          # Retourner les données au format JSON pour XCom
-          return df_filtered.to_json(orient='records')
+          # Déposer le sous-ensemble en Parquet dans MinIO, seule la clé transite par XCom
+          buf = BytesIO()
+          df_filtered.to_parquet(buf, compression='zstd', index=False)
+          s3_hook.load_bytes(buf.getvalue(), key=staging_key, bucket_name=bucket_name, replace=True)
+          
+          return staging_key
           
       except Exception as e:
           logger.error(f"Erreur MinIO: {e}")
           raise DataInjectionError(f"Impossible de lire {file_name}") from e
     
     
-    @task
-    def load_data_to_postgres(data_json: str):
+    @task(pool='postgres_pool')
+    def load_table(table: str, staging_key: str):
+        import pandas as pd
         
-        if data_json is None:
-          logger.info("SKIPPED: Pas de données à charger")
+        if staging_key is None:
+          logger.info(f"SKIPPED: Pas de données à charger dans {table}")
           return {
               'status': 'skipped',
               'rows_inserted': 0,
               'message': 'Pas de données à charger'
           }
         
-        # Reconvertir JSON en DataFrame
-        df = pd.read_json(StringIO(data_json))
+        bucket_name = Variable.get("minio_bucket_name")
+        s3_hook = get_s3_hook()
         
-        # Remplacer NaN par None pour PostgreSQL
-        df = df.where(pd.notnull(df), None)
+        # Relire uniquement les colonnes de la table dans le Parquet déposé par extract_data_from_minio
+        obj = s3_hook.get_key(key=staging_key, bucket_name=bucket_name)
+        df = pd.read_parquet(BytesIO(obj.get()['Body'].read()), columns=TABLES[table][0], dtype_backend='pyarrow')
         
-        pg_hook = PostgresHook(postgres_conn_id='postgres_external')
+        pg_hook = get_pg_hook()
         
         try:
             conn = pg_hook.get_conn()
             cur = conn.cursor()
             
-            logger.info(f"Insertion de {len(df)} lignes en base...")
+            logger.info(f"Insertion de {len(df)} lignes dans {table}...")
             
-            inserted_count = 0
+            # Source de vérité dans MinIO : un COMMIT perdu se rejoue au retry, inutile d'attendre le fsync du WAL
+            cur.execute("SET LOCAL synchronous_commit = off")
             
-            for _, row in df.iterrows():
-
-                try:
-
-                  # Insert Client
-                  cur.execute("""
-                      INSERT INTO client (customer_id, first_name, last_name, email, country, signup_date, gender, age_range)
-                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                      ON CONFLICT (customer_id) DO NOTHING
-                  """, (
-                      row['customer_id'], row['first_name'], row['last_name'],
-                      row['email'], row['country'], row['signup_date'],
-                      row['gender'], row['age_range']
-                  ))
-                  
-                  # Insert Product
-                  cur.execute("""
-                      INSERT INTO product (product_id, product_name, brand, category, cost_price, color, size, catalog_price)
-                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                      ON CONFLICT (product_id) DO NOTHING
-                  """, (
-                      row['product_id'], row['product_name'], row['brand'],
-                      row['category'], row['cost_price'], row['color'],
-                      row['size'], row['catalog_price']
-                  ))
-                  
-                  # Insert Sale
-                  cur.execute("""
-                      INSERT INTO sale (sale_id, sale_date, channel, channel_campaigns, customer_id)
-                      VALUES (%s, %s, %s, %s, %s)
-                      ON CONFLICT (sale_id) DO NOTHING
-                  """, (
-                      row['sale_id'], row['sale_date'], row['channel'],
-                      row['channel_campaigns'], row['customer_id']
-                  ))
-                  
-                  # Insert Sale_Product
-                  cur.execute("""
-                      INSERT INTO sale_product (item_id, sale_id, product_id, quantity, discount_applied)
-                      VALUES (%s, %s, %s, %s, %s)
-                      ON CONFLICT (item_id) DO NOTHING
-                  """, (
-                      row['item_id'], row['sale_id'], row['product_id'],
-                      row['quantity'], row['discount_applied']
-                  ))
-                  
-                  inserted_count += 1
-              
-                except Exception as e:
-                  logger.error(f"Erreur lors de l'insertion de la ligne {row['sale_id']}: {e}")
-                  continue
+            inserted_count = copy_table(cur, df, table)
             
             conn.commit()
             cur.close()
             conn.close()
             
-            logger.info(f"Workflow terminé avec succès, {inserted_count} / {len(df)} lignes insérées.")
+            logger.info(f"Chargement de {table} terminé, {inserted_count} / {len(df)} lignes insérées.")
             
             return {
                 'status': 'success',
@@ -212,8 +320,8 @@ def fashion_store_etl():
             }
             
         except Exception as e:
-            logger.error(f"Erreur PostgreSQL lors de l'insertion: {e}")
-            raise DataInjectionError("Impossible d'insérer les données") from e
+            logger.error(f"Erreur PostgreSQL lors de l'insertion dans {table}: {e}")
+            raise DataInjectionError(f"Impossible d'insérer les données dans {table}") from e
     
     
     @task
@@ -223,7 +331,7 @@ def fashion_store_etl():
         rows = result.get('rows_inserted', 0)
         message = result.get('message', '')
         
-        formatted_date = datetime.strptime(date, "%Y%m%d").strftime("%Y-%m-%d")
+        formatted_date = format_date(date)
         
         if status == 'success':
             logger.info(f"SUCCESS: {rows} lignes insérées pour {formatted_date}")
@@ -235,9 +343,17 @@ def fashion_store_etl():
     
     # Définir le flux du DAG
     execution_date = validate_execution_date()
-    date_exists = check_date_exists(execution_date)
-    data = extract_data_from_minio(execution_date, date_exists)
-    result = load_data_to_postgres(data)
+    staging_key = extract_data_from_minio(execution_date)
+    
+    # client et product en parallèle, puis sale, puis sale_product (clés étrangères)
+    load_client = load_table.override(task_id='load_client')('client', staging_key)
+    load_product = load_table.override(task_id='load_product')('product', staging_key)
+    load_sale = load_table.override(task_id='load_sale')('sale', staging_key)
+    result = load_table.override(task_id='load_sale_product')('sale_product', staging_key)
+    
+    load_client >> load_sale
+    [load_product, load_sale] >> result
+    
     send_notification(result, execution_date)
 
 
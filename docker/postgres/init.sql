@@ -40,6 +40,7 @@ CREATE TABLE IF NOT EXISTS sale_product (
 );
 
 CREATE INDEX IF NOT EXISTS idx_sale_customer_id ON sale(customer_id);
+CREATE INDEX IF NOT EXISTS idx_sale_sale_date ON sale(sale_date);
 CREATE INDEX IF NOT EXISTS idx_sale_product_sale_id ON sale_product(sale_id);
 CREATE INDEX IF NOT EXISTS idx_sale_product_product_id ON sale_product(product_id);
 
@@ -1,14 +1,19 @@
+import functools
 import os
 import sys
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
 
 import pandas as pd
+import polars as pl
+import pyarrow as pa
 from dotenv import load_dotenv
 from minio import Minio
 from minio.error import S3Error
 import psycopg
+from pgpq import ArrowToPostgresBinaryEncoder
 
 load_dotenv()
 
@@ -25,97 +30,197 @@ class DataInjectionError(Exception):
     pass
 
 
+# Tables cibles : colonnes et clé de conflit
+TABLES = {
+    "client": (
+        ["customer_id", "first_name", "last_name", "email", "country", "signup_date", "gender", "age_range"],
+        "customer_id"
+    ),
+    "product": (
+        ["product_id", "product_name", "brand", "category", "cost_price", "color", "size", "catalog_price"],
+        "product_id"
+    ),
+    "sale": (
+        ["sale_id", "sale_date", "channel", "channel_campaigns", "customer_id"],
+        "sale_id"
+    ),
+    "sale_product": (
+        ["item_id", "sale_id", "product_id", "quantity", "discount_applied"],
+        "item_id"
+    ),
+}
+
+# Conditions ajoutées à l'INSERT ... SELECT depuis la table temporaire : une date
+# déjà présente dans sale n'est pas rechargée, et les lignes de sale_product dont la
+# vente a été écartée sont ignorées au lieu de violer la clé étrangère
+INSERT_GUARDS = {
+    "sale": "WHERE NOT EXISTS (SELECT 1 FROM sale s WHERE s.sale_date = stg_sale.sale_date)",
+    "sale_product": "WHERE EXISTS (SELECT 1 FROM sale s WHERE s.sale_id = stg_sale_product.sale_id)",
+}
+
+# Lecture des objets MinIO par plages d'octets concurrentes
+RANGE_WORKERS = 16
+RANGE_MIN_SIZE = 256 * 1024
+
+# Types imposés au parseur CSV pour chaque colonne chargée : polars n'infère les types que
+# sur les 100 premières lignes (une taille "35" ferait typer size en entier). sale_date est
+# lu en texte pour le filtrage, identifiants et quantités en int32 comme les colonnes INTEGER cibles
+CSV_COLUMN_TYPES = {
+    "sale_date": pl.String,
+    "sale_id": pl.Int32,
+    "item_id": pl.Int32,
+    "customer_id": pl.Int32,
+    "product_id": pl.Int32,
+    "quantity": pl.Int32,
+    "discount_applied": pl.Float64,
+    "channel": pl.String,
+    "channel_campaigns": pl.String,
+    "product_name": pl.String,
+    "brand": pl.String,
+    "category": pl.String,
+    "cost_price": pl.Float64,
+    "color": pl.String,
+    "size": pl.String,
+    "catalog_price": pl.Float64,
+    "first_name": pl.String,
+    "last_name": pl.String,
+    "email": pl.String,
+    "country": pl.String,
+    "signup_date": pl.Date,
+    "gender": pl.String,
+    "age_range": pl.String,
+}
+
+DATE_RE = re.compile(r"[0-9]{8}")
+
+
 def validate_date(date: str) -> bool:
-    if len(date) != 8 or not date.isdigit():
+    if not DATE_RE.fullmatch(date):
         return False
     try:
-        datetime.strptime(date, "%Y%m%d")
+        datetime(int(date[:4]), int(date[4:6]), int(date[6:]))
         return True
     except ValueError:
         return False
 
+
+@functools.lru_cache(maxsize=32)
+def format_date(date: str) -> str:
+    return datetime.strptime(date, "%Y%m%d").strftime("%Y-%m-%d")
+
+
+def read_sales_csv(csv_content: bytes, sale_date: str) -> pa.Table:
+    # Parsing multi-cœurs, filtre poussé dans le scan : les autres dates ne sont jamais matérialisées
+    return (
+        pl.scan_csv(csv_content, schema_overrides=CSV_COLUMN_TYPES)
+        # Seules les colonnes chargées sont parsées, les autres ne dépendent pas de l'inférence
+        .select(list(CSV_COLUMN_TYPES))
+        .filter(pl.col("sale_date") == sale_date)
+        # sale_date n'est lu en texte que pour le filtrage
+        .with_columns(pl.col("sale_date").str.to_date("%Y-%m-%d"))
+        .collect()
+        .to_arrow()
+    )
+
+
+def copy_table(cur: psycopg.Cursor, df: pd.DataFrame, table: str) -> int:
+    columns, key = TABLES[table]
+    cols = ", ".join(columns)
+
+    # Une ligne par clé : un client ou un produit revient sur plusieurs lignes de vente.
+    data = pa.Table.from_pandas(df[columns].drop_duplicates(key), preserve_index=False)
+
+    # pgpq encode les colonnes Arrow au format COPY binaire : ni texte côté client, ni parsing côté serveur.
+    # La table temporaire prend les types Postgres correspondant aux types Arrow,
+    # l'INSERT ... SELECT fait la conversion vers les types de la table cible.
+    encoder = ArrowToPostgresBinaryEncoder(data.schema)
+    stg_cols = ", ".join(f"{column.name} {column.data_type.ddl()}" for column in encoder.schema().columns)
+
+    cur.execute(f"CREATE TEMP TABLE stg_{table} ({stg_cols}) ON COMMIT DROP")
+    with cur.copy(f"COPY stg_{table} ({cols}) FROM STDIN WITH (FORMAT BINARY)") as copy:
+        copy.write(encoder.write_header())
+        for batch in data.to_batches():
+            copy.write(encoder.write_batch(batch))
+        copy.write(encoder.finish())
+    cur.execute(f"""
+        INSERT INTO {table} ({cols})
+        SELECT {cols} FROM stg_{table}
+        {INSERT_GUARDS.get(table, '')}
+        ON CONFLICT ({key}) DO NOTHING
+    """)
+    return cur.rowcount
+
 class DataInjection:
     def __init__(self, bucket:str, file:str, client:Minio, database_url:str):
         self.bucket = bucket
         self.file = file
         self.client = client
         self.database_url = database_url
+        self.conn: psycopg.Connection | None = None
     
+    def get_connection(self) -> psycopg.Connection:
+        # Une seule connexion pour tout le workflow : un seul handshake (TLS, auth) par exécution
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg.connect(self.database_url, autocommit=True)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def read_object(self) -> bytes:
+        stat = self.client.stat_object(self.bucket, self.file)
+        size = stat.size
+        if size == 0:
+            return b""
+
+        parts = max(1, min(RANGE_WORKERS, size // RANGE_MIN_SIZE))
+        step = -(-size // parts)
+        # If-Match : si l'objet est remplacé entre deux plages, la requête échoue (412)
+        # au lieu de recoller des morceaux de deux versions différentes
+        headers = {"If-Match": f'"{stat.etag}"'}
+
+        def fetch(offset: int) -> bytes:
+            with self.client.get_object(self.bucket, self.file, offset=offset, length=min(step, size - offset), request_headers=headers) as response:
+                return response.read()
+
+        with ThreadPoolExecutor(max_workers=parts) as executor:
+            return b"".join(executor.map(fetch, range(0, size, step)))
+
     def extract_data_from_minio(self, date: str) -> pd.DataFrame:
-        formatted_date = datetime.strptime(date, "%Y%m%d").strftime("%Y-%m-%d")
+        formatted_date = format_date(date)
         try:
-            with self.client.get_object(self.bucket, self.file) as response:
-                df = pd.read_csv(BytesIO(response.read()))
-            return df[df["sale_date"] == formatted_date].drop_duplicates()
+            # Colonnes adossées à Arrow : les valeurs manquantes restent des NULL (bitmap), pas des NaN/objets
+            table = read_sales_csv(self.read_object(), formatted_date)
+            return table.to_pandas(types_mapper=pd.ArrowDtype).drop_duplicates()
         except S3Error as e:
             logger.error("Erreur Minio: %s", e)
             raise DataInjectionError(f"Impossible de lire {self.file}") from e
     
     def check_date_exists(self, date: str) -> bool:
-        formatted_date = datetime.strptime(date, "%Y%m%d").strftime("%Y-%m-%d")
+        formatted_date = format_date(date)
         try:
-            with psycopg.connect(self.database_url) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "SELECT EXISTS(SELECT 1 FROM sale WHERE sale_date = %s)",
-                        (formatted_date,)
-                    )
-                    return cur.fetchone()[0]
+            with self.get_connection().cursor() as cur:
+                cur.execute(
+                    "SELECT EXISTS(SELECT 1 FROM sale WHERE sale_date = %s)",
+                    (formatted_date,)
+                )
+                return cur.fetchone()[0]
         except psycopg.Error as e:
             logger.error("Erreur PostgreSQL: %s", e)
             raise DataInjectionError("Impossible de vérifier la date en base") from e
 
     def load_data_to_postgres(self, df: pd.DataFrame):
         try:
-            df = df.astype(object).where(pd.notnull(df), None)
-            with psycopg.connect(self.database_url) as conn:
-                with conn.cursor() as cur:
-                    
-                    inserted_count = 0;
-                    for _, row in df.iterrows():
-                        try:
-                            cur.execute("""
-                                INSERT INTO client (customer_id, first_name, last_name, email, country, signup_date, gender, age_range)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                                ON CONFLICT (customer_id) DO NOTHING
-                            """, (
-                                row['customer_id'], row['first_name'], row['last_name'],
-                                row['email'], row['country'], row['signup_date'],
-                                row['gender'], row['age_range']
-                            ))
-                            cur.execute("""
-                                INSERT INTO product (product_id, product_name, brand, category, cost_price, color, size, catalog_price)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                                ON CONFLICT (product_id) DO NOTHING
-                            """, (
-                                row['product_id'], row['product_name'], row['brand'],
-                                row['category'], row['cost_price'], row['color'],
-                                row['size'], row['catalog_price']
-                            ))
-                            cur.execute("""
-                                INSERT INTO sale (sale_id, sale_date, channel, channel_campaigns, customer_id)
-                                VALUES (%s, %s, %s, %s, %s)
-                                ON CONFLICT (sale_id) DO NOTHING
-                            """, (
-                                row['sale_id'], row['sale_date'], row['channel'],
-                                row['channel_campaigns'], row['customer_id']
-                            ))
-                            cur.execute("""
-                                INSERT INTO sale_product (item_id, sale_id, product_id, quantity, discount_applied)
-                                VALUES (%s, %s, %s, %s, %s)
-                                ON CONFLICT (item_id) DO NOTHING
-                            """, (
-                                row['item_id'], row['sale_id'], row['product_id'],
-                                row['quantity'], row['discount_applied']
-                            ))
-                        
-                            inserted_count += 1
-                        except psycopg.Error as e:
-                            logger.error("Erreur PostgreSQL lors de l'insertion d'une ligne: %s", e)
-                            conn.rollback()
-                            continue
-                        
-                conn.commit()
+            conn = self.get_connection()
+            with conn.transaction(), conn.cursor() as cur:
+                # Source de vérité dans MinIO : un COMMIT perdu se rejoue, inutile d'attendre le fsync du WAL
+                cur.execute("SET LOCAL synchronous_commit = off")
+
+                # Ordre imposé par les clés étrangères
+                for table in TABLES:
+                    copy_table(cur, df, table)
         except psycopg.Error as e:
             logger.error("Erreur PostgreSQL lors de l'insertion: %s", e)
             raise DataInjectionError("Impossible d'insérer les données") from e
@@ -145,6 +250,8 @@ class DataInjection:
         except Exception as e:
             logger.exception("Erreur inattendue: %s", e)
             return False
+        finally:
+            self.close()
 
 
 def main():